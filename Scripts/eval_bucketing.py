@@ -1,9 +1,26 @@
-
 #!/usr/bin/env python3
-import argparse, ast, sys
+import argparse, ast, json, re, sys
+from collections import Counter
 from typing import List, Dict, Tuple, Set
+import numpy as np
 import pandas as pd
 
+try:
+    import numba
+except ImportError:  # optional: bucketing falls back to the pure-Python path
+    numba = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional: reading falls back to pandas' C engine
+    pa = None
+
+try:
+    import orjson
+except ImportError:  # optional: summary falls back to stdlib json
+    orjson = None
+
 EMOTION_MAP = {
     "happy":"joy","excited":"joy","proud":"joy","grateful":"joy","relieved":"joy",
     "motivated":"joy","loved":"joy","satisfied":"joy",
@@ -63,120 +80,323 @@ DOMAIN_ADJ = {
     ("school/learning","self/growth/habits")
 }
 
+# Symmetric closures, built once so adjacency is a single hashed lookup
+EMOTION_ADJ_SYM = {k: frozenset(v | {j for j, w in EMOTION_ADJ.items() if k in w})
+                   for k, v in EMOTION_ADJ.items()}
+
+DOMAIN_ADJ_SYM: Dict[str, Set[str]] = {}
+for _a, _b in DOMAIN_ADJ:
+    DOMAIN_ADJ_SYM.setdefault(_a, set()).add(_b)
+    DOMAIN_ADJ_SYM.setdefault(_b, set()).add(_a)
+
+# Split-on-"/" parts of each canonical domain, interned once; non-canonical
+# slash strings are memoized on first sight in _bucket_domain
+_DOM_PARTS = {canon: frozenset(canon.split("/")) for canon in set(DOMAIN_ALIAS.values())}
+
 def ensure_list(x):
     if isinstance(x, list): return x
     if isinstance(x, str):
-        try: return ast.literal_eval(x)
-        except Exception: return []
+        s = x.strip()
+        if not s or s == "[]": return []
+        if s.startswith("["):
+            # json is ~20x faster than ast.literal_eval; fall back for
+            # Python-style single-quoted lists
+            try: return json.loads(s)
+            except json.JSONDecodeError:
+                try: return ast.literal_eval(s)
+                except Exception: return []
+        return [p for p in s.split(";") if p]
     return []
 
-def normalize_emotion_label(e: str) -> str:
-    if e is None: return ""
-    s = str(e)
-    for k in ["Joy","Sadness","Anger","Fear","Surprise","Disgust","Neutral","Mixed"]:
-        if k in s: return k.lower()
-    return s.strip().lower()
+_EMO_RX = re.compile(r"(Joy|Sadness|Anger|Fear|Surprise|Disgust|Neutral|Mixed)")
 
-def canonical_domain(s: str) -> str:
-    if s is None: return ""
-    s = str(s).strip().lower()
-    return DOMAIN_ALIAS.get(s, s)
+def _bucket_emotion(mset: frozenset, c: str) -> int:
+    if not mset and not c: return 2
+    if c in mset: return 1
+    if c == "mixed" and len(mset) > 1: return 2
+    if any(mm in EMOTION_ADJ_SYM.get(c, ()) for mm in mset): return 2
+    return 3
 
-def is_domain_adjacent(a: str, b: str) -> bool:
-    if not a or not b: return False
-    x, y = a.lower(), b.lower()
-    return x == y or (x,y) in DOMAIN_ADJ or (y,x) in DOMAIN_ADJ
+def _bucket_domain(mset: frozenset, c: str) -> int:
+    if not mset and not c: return 2
+    if c in mset: return 1
+    parts = _DOM_PARTS.get(c)
+    if parts is None and "/" in c:
+        parts = _DOM_PARTS[c] = frozenset(c.split("/"))
+    if parts and parts & mset: return 1
+    if any(mm in DOMAIN_ADJ_SYM.get(c, ()) for mm in mset): return 2
+    return 3
 
-def main(args):
-    df = pd.read_csv(args.input)
+def _bucket_kernel(codes, masks, sizes, hit_masks, adj_masks, mixed_code, out):
+    # Branchy scalar loop over int codes and uint64 label bitmasks; compiled
+    # with numba when available, otherwise unused.
+    for i in range(codes.shape[0]):
+        c = codes[i]
+        m = masks[i]
+        if m == 0 and c < 0:
+            out[i] = 2
+        elif c >= 0 and hit_masks[c] & m:
+            out[i] = 1
+        elif c == mixed_code and sizes[i] > 1:
+            out[i] = 2
+        elif c >= 0 and adj_masks[c] & m:
+            out[i] = 2
+        else:
+            out[i] = 3
+
+if numba is not None:
+    _bucket_kernel = numba.njit(cache=True)(_bucket_kernel)
+
+# Build a dense decision table when 2^n_labels stays this small; lookup
+# is then a single NumPy gather per bucket column
+LUT_MAX_LABELS = 16
+
+def _encode_labels(classifier, manual_sets, adj_sym, split_slash=False, mixed_label=None):
+    """Integer-encode the observed label vocabulary for the bitmask paths.
+
+    Returns None when the vocabulary does not fit in a 64-bit mask, in
+    which case the caller uses the set-based path.
+    """
+    vocab: Dict[str, int] = {}
+    for s in manual_sets:
+        for x in s:
+            vocab.setdefault(x, len(vocab))
+    for c in classifier:
+        if c:
+            vocab.setdefault(c, len(vocab))
+    if len(vocab) > 64:
+        return None
+
+    codes = np.array([vocab[c] if c else -1 for c in classifier], dtype=np.int16)
+    masks = np.zeros(len(manual_sets), dtype=np.uint64)
+    sizes = np.zeros(len(manual_sets), dtype=np.int16)
+    for i, s in enumerate(manual_sets):
+        m = 0
+        for x in s:
+            m |= 1 << vocab[x]
+        masks[i] = m
+        sizes[i] = len(s)
+
+    n_labels = max(len(vocab), 1)
+    hit_masks = np.zeros(n_labels, dtype=np.uint64)
+    adj_masks = np.zeros(n_labels, dtype=np.uint64)
+    for label, code in vocab.items():
+        hit = 1 << code
+        if split_slash and "/" in label:
+            for p in label.split("/"):
+                if p in vocab:
+                    hit |= 1 << vocab[p]
+        hit_masks[code] = hit
+        adj = 0
+        for other in adj_sym.get(label, ()):
+            if other in vocab:
+                adj |= 1 << vocab[other]
+        adj_masks[code] = adj
+
+    mixed_code = vocab.get(mixed_label, -2) if mixed_label else -2
+    return codes, masks, sizes, hit_masks, adj_masks, mixed_code, len(vocab)
+
+def _popcount(m: np.ndarray) -> np.ndarray:
+    """Per-element set-bit count; np.bitwise_count needs NumPy >= 2.0,
+    so older installs unpack the mask bytes instead."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(m)
+    return np.unpackbits(m.astype(">u8").view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def _build_bucket_lut(hit_masks, adj_masks, mixed_code, n_labels):
+    """Precompute bucket decisions for every (code, manual bitmask) pair.
+
+    Row 0 holds the empty-classifier code (-1); LUT is indexed as
+    LUT[code + 1, mask]. Built with broadcast bitwise ops, no Python loop.
+    """
+    m = np.arange(1 << n_labels, dtype=np.uint64)
+    sizes = _popcount(m)
+    hitp = np.concatenate(([0], hit_masks)).astype(np.uint64)
+    adjp = np.concatenate(([0], adj_masks)).astype(np.uint64)
+    codes_col = np.arange(-1, n_labels)[:, None]
+    hit   = (hitp[:, None] & m) != 0
+    adj   = (adjp[:, None] & m) != 0
+    empty = (m == 0) & (codes_col < 0)
+    mixed = (codes_col == mixed_code) & (sizes > 1)
+    return np.select([hit, empty | mixed | adj], [1, 2], default=3).astype(np.int8)
 
+def _mismatch_pairs(sub: pd.DataFrame, list_col: str, pred_col: str):
+    """(manual, predicted) arrays for mismatch rows, sized exactly from the
+    list lengths: one C-level concatenate + repeat, no per-row appends."""
+    lens = sub[list_col].str.len().to_numpy()
+    if len(lens) == 0 or lens.sum() == 0:
+        empty = np.empty(0, dtype=object)
+        return empty, empty
+    manual = np.concatenate(sub[list_col].to_numpy())
+    pred   = np.repeat(sub[pred_col].to_numpy(), lens)
+    return manual, pred
+
+def _bucket_column(classifier, manual_sets, adj_sym, scalar_fn, **enc_kwargs):
+    """Bucket only the unique (classifier, manual set) pairs, then
+    broadcast back by factorized code — rig CSVs repeat the same handful
+    of combinations across many rows."""
+    keys = pd.Series(list(zip(classifier, manual_sets)), dtype=object)
+    codes, uniq = pd.factorize(keys)
+    u_cls = np.array([k[0] for k in uniq], dtype=object)
+    u_sets = np.array([k[1] for k in uniq], dtype=object)
+    buckets = _bucket_encoded(u_cls, u_sets, adj_sym, **enc_kwargs)
+    if buckets is None:
+        buckets = [scalar_fn(s, c) for c, s in uniq]
+    return np.asarray(buckets, dtype=np.int64)[codes]
+
+def _bucket_encoded(classifier, manual_sets, adj_sym, split_slash=False, mixed_label=None):
+    """Bucket via LUT gather or numba kernel; None means use the set path."""
+    enc = _encode_labels(classifier, manual_sets, adj_sym, split_slash, mixed_label)
+    if enc is None:
+        return None
+    codes, masks, sizes, hit_masks, adj_masks, mixed_code, n_labels = enc
+    if n_labels <= LUT_MAX_LABELS:
+        lut = _build_bucket_lut(hit_masks, adj_masks, mixed_code, n_labels)
+        return lut[codes.astype(np.intp) + 1, masks.astype(np.intp)].astype(np.int64)
+    if numba is not None:
+        out = np.empty(len(codes), dtype=np.int64)
+        _bucket_kernel(codes, masks, sizes, hit_masks, adj_masks, mixed_code, out)
+        return out
+    return None
+
+# Rows per read_csv chunk; keeps the working set small on large rig dumps
+CHUNK_ROWS = 100_000
+
+def read_chunks(path: str):
+    """Yield DataFrame chunks; pyarrow's multithreaded reader when available.
+
+    Quoted free-text columns may carry embedded newlines, which arrow
+    rejects by default; missing string cells come back as "" so both
+    readers feed process_chunk equivalent frames (the pandas path's NaNs
+    are normalized to "" in the classifier pipelines).
+    """
+    if pa is not None:
+        parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+        with pa_csv.open_csv(path, parse_options=parse_options) as reader:
+            for batch in reader:
+                yield pa.Table.from_batches([batch]).to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=CHUNK_ROWS)
+
+def process_chunk(df: pd.DataFrame) -> pd.DataFrame:
     # Build manual labels from boolean columns if not present
     if "manual_emotions" not in df.columns or "manual_domains" not in df.columns:
-        emo_cols = [c for c in df.columns if c.startswith("Answer.f1.")]
-        dom_cols = [c for c in df.columns if c.startswith("Answer.t1.")]
-        def get_labels(row, cols, prefix):
-            out = []
-            for c in cols:
-                v = row.get(c, False)
-                if v is True:
-                    out.append(c.replace(prefix,"").replace(".raw","").strip().lower())
-            return out
-        df["manual_emotions"] = df.apply(lambda r: get_labels(r, emo_cols, "Answer.f1."), axis=1)
-        df["manual_domains"]  = df.apply(lambda r: get_labels(r, dom_cols, "Answer.t1."), axis=1)
+        cols = df.columns.to_numpy()
+        def get_labels(prefix):
+            mask = df.columns.str.startswith(prefix)
+            labels = np.array([c.replace(prefix,"").replace(".raw","").strip().lower() for c in cols[mask]], dtype=object)
+            mat = df.loc[:, mask].fillna(False).to_numpy(dtype=bool)
+            return [list(labels[row]) for row in mat]
+        manual_emotions = get_labels("Answer.f1.")
+        manual_domains  = get_labels("Answer.t1.")
+        df["manual_emotions"] = manual_emotions
+        df["manual_domains"]  = manual_domains
     else:
-        df["manual_emotions"] = df["manual_emotions"].apply(ensure_list)
-        df["manual_domains"]  = df["manual_domains"].apply(ensure_list)
+        df["manual_emotions"] = df["manual_emotions"].map(ensure_list)
+        df["manual_domains"]  = df["manual_domains"].map(ensure_list)
 
     # Map manual emotions to coarse buckets
     def map_manual_emotions(lst: List[str]) -> List[str]:
         return sorted(set([EMOTION_MAP.get(x, x) for x in lst]))
     df["manual_emotions_coarse"] = df["manual_emotions"].apply(map_manual_emotions)
 
-    # Normalize classifier outputs
-    df["classifier_emotion_norm"] = df["EmotionPro"].astype(str).str.split("–").str[-1].str.strip().apply(normalize_emotion_label)
-    df["classifier_domain_norm"]  = df["DomainPro"].astype(str).str.lower().str.strip().apply(canonical_domain)
+    # Normalize classifier outputs. Missing cells deliberately normalize
+    # to "" ("classifier gave no label"), so a row with neither manual
+    # labels nor a classifier value buckets as 2, not as a mismatch on
+    # the literal string "nan".
+    emo_raw = df["EmotionPro"].astype(str).str.extract(r"([^–]+)\s*$", expand=False).fillna("").str.strip()
+    df["classifier_emotion_norm"] = emo_raw.str.extract(_EMO_RX, expand=False).fillna(emo_raw).str.lower()
+    dom_raw = df["DomainPro"].astype(str).str.lower().str.strip().fillna("")
+    df["classifier_domain_norm"]  = dom_raw.map(DOMAIN_ALIAS).fillna(dom_raw)
+
+    # Tiny cardinality after normalization: categorical codes make the
+    # comparisons, value_counts and crosstab below run on small ints.
+    # Categories are inferred, not fixed, because unmapped labels pass
+    # through normalization.
+    df["classifier_emotion_norm"] = df["classifier_emotion_norm"].astype("category")
+    df["classifier_domain_norm"]  = df["classifier_domain_norm"].astype("category")
 
     # Canonicalize manual domains
-    df["manual_domains_canon"] = df["manual_domains"].apply(lambda lst: [canonical_domain(x) for x in lst])
-
-    # Buckets
-    def bucket_emotion(row) -> int:
-        mset = set(row["manual_emotions_coarse"])
-        c = row["classifier_emotion_norm"]
-        if not mset and not c: return 2
-        if c in mset: return 1
-        if c == "mixed" and len(mset) > 1: return 2
-        if any((c in EMOTION_ADJ and mm in EMOTION_ADJ[c]) or (mm in EMOTION_ADJ and c in EMOTION_ADJ[mm]) for mm in mset):
-            return 2
-        return 3
-
-    def bucket_domain(row) -> int:
-        mset = set([x for x in row["manual_domains_canon"] if x])
-        c = row["classifier_domain_norm"]
-        if not mset and not c: return 2
-        if c in mset: return 1
-        if "/" in c and any(p in mset for p in c.split("/")): return 1
-        if any(is_domain_adjacent(c, mm) for mm in mset): return 2
-        return 3
-
-    df["bucket_emotion"] = df.apply(bucket_emotion, axis=1)
-    df["bucket_domain"]  = df.apply(bucket_domain,  axis=1)
-
-    # Counts
-    emotion_counts = df["bucket_emotion"].value_counts().sort_index()
-    domain_counts  = df["bucket_domain"].value_counts().sort_index()
-
-    # Confusion matrices (mismatches only)
-    mm_e = df[df["bucket_emotion"] == 3]
-    emo_pairs = []
-    for _, row in mm_e.iterrows():
-        pred = row["classifier_emotion_norm"]
-        for m in row["manual_emotions_coarse"]:
-            emo_pairs.append((m, pred))
-    emo_df = pd.DataFrame(emo_pairs, columns=["manual","predicted"])
-    emo_cm = pd.crosstab(emo_df["manual"], emo_df["predicted"])
-
-    mm_d = df[df["bucket_domain"] == 3]
-    dom_pairs = []
-    for _, row in mm_d.iterrows():
-        pred = row["classifier_domain_norm"]
-        for m in row["manual_domains_canon"]:
-            dom_pairs.append((m, pred))
-    dom_df = pd.DataFrame(dom_pairs, columns=["manual","predicted"])
-    dom_cm = pd.crosstab(dom_df["manual"], dom_df["predicted"])
+    df["manual_domains_canon"] = df["manual_domains"].map(
+        lambda lst: [DOMAIN_ALIAS.get(y := str(x).strip().lower(), y) for x in lst])
+
+    # Cache the manual label sets once; the bucketing masks reuse them
+    df["_me_set"] = df["manual_emotions_coarse"].map(lambda l: frozenset(x for x in l if x))
+    df["_md_set"] = df["manual_domains_canon"].map(lambda l: frozenset(x for x in l if x))
 
+    # Buckets: deduplicate to unique (classifier, manual set) pairs, then
+    # LUT gather / numba bitmask kernel when the vocabulary permits, else
+    # the zipped set-based pass
+    df["bucket_emotion"] = _bucket_column(df["classifier_emotion_norm"].values, df["_me_set"].values,
+                                          EMOTION_ADJ_SYM, _bucket_emotion, mixed_label="mixed")
+    df["bucket_domain"]  = _bucket_column(df["classifier_domain_norm"].values, df["_md_set"].values,
+                                          DOMAIN_ADJ_SYM, _bucket_domain, split_slash=True)
+    return df
+
+def main(args):
     # Output paths
     out_aug   = args.output or args.input.replace(".csv","_with_buckets.csv")
     out_emo   = args.emotion_cm or args.input.replace(".csv","_emotion_cm.csv")
     out_dom   = args.domain_cm  or args.input.replace(".csv","_domain_cm.csv")
 
-    df.to_csv(out_aug, index=False)
+    # Stream the input in chunks: each chunk is processed and appended to
+    # the augmented CSV; only the lightweight per-row outputs (bucket
+    # counts, mismatch pairs) are carried across chunks.
+    emotion_counts: Counter = Counter()
+    domain_counts:  Counter = Counter()
+    emo_mm_parts, dom_mm_parts = [], []
+    first = True
+    for df in read_chunks(args.input):
+        df = process_chunk(df)
+
+        emotion_counts.update(df["bucket_emotion"].tolist())
+        domain_counts.update(df["bucket_domain"].tolist())
+
+        # Confusion matrices (mismatches only)
+        emo_mm_parts.append(_mismatch_pairs(
+            df.loc[df["bucket_emotion"] == 3, ["manual_emotions_coarse","classifier_emotion_norm"]],
+            "manual_emotions_coarse", "classifier_emotion_norm"))
+        dom_mm_parts.append(_mismatch_pairs(
+            df.loc[df["bucket_domain"] == 3, ["manual_domains_canon","classifier_domain_norm"]],
+            "manual_domains_canon", "classifier_domain_norm"))
+
+        # Serialize list columns as ";"-joined strings (vectorized; avoids
+        # pandas rendering each list through str()) and emit the chunk
+        # without building one full string buffer. ensure_list understands
+        # the joined form, so augmented CSVs still round-trip as input.
+        # --minimal-output keeps only the derived columns, skipping the
+        # rewrite of the (often very wide) Answer.* input columns.
+        if args.minimal_output:
+            out = df[["bucket_emotion","bucket_domain",
+                      "classifier_emotion_norm","classifier_domain_norm",
+                      "manual_emotions_coarse","manual_domains_canon"]].copy()
+            join_cols = ("manual_emotions_coarse", "manual_domains_canon")
+        else:
+            out = df.drop(columns=["_me_set", "_md_set"])
+            join_cols = ("manual_emotions", "manual_domains",
+                         "manual_emotions_coarse", "manual_domains_canon")
+        for col in join_cols:
+            out[col] = out[col].str.join(";")
+        out.to_csv(out_aug, index=False, mode="w" if first else "a", header=first,
+                   chunksize=50_000, lineterminator="\n")
+        first = False
+
+    # Categorize from the observed mismatch values so crosstab aggregates
+    # int codes without emitting all-zero rows/columns
+    def build_cm(parts):
+        manual = pd.Series(np.concatenate([m for m, _ in parts]), name="manual", dtype=object)
+        pred   = pd.Series(np.concatenate([p for _, p in parts]), name="predicted", dtype=object)
+        return pd.crosstab(manual.astype("category"), pred.astype("category"))
+
+    emo_cm = build_cm(emo_mm_parts)
+    dom_cm = build_cm(dom_mm_parts)
+
     emo_cm.to_csv(out_emo)
     dom_cm.to_csv(out_dom)
 
     # Print a small summary to stdout
-    def fmt_count(s):
-        return {int(k): int(v) for k,v in s.to_dict().items()}
+    def fmt_count(c):
+        return {int(k): int(v) for k,v in sorted(c.items())}
     summary = {
         "emotion_buckets": fmt_count(emotion_counts),
         "domain_buckets":  fmt_count(domain_counts),
@@ -186,7 +406,12 @@ def main(args):
             "domain_confusion_csv": out_dom
         }
     }
-    print(summary)
+    # JSON so downstream dashboards can parse the output without a regex
+    if orjson is not None:
+        sys.stdout.buffer.write(orjson.dumps(
+            summary, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS) + b"\n")
+    else:
+        print(json.dumps(summary, indent=2))
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser(description="Evaluate classifier outputs vs manual labels with adjacency-aware bucketing.")
@@ -194,5 +419,7 @@ if __name__ == "__main__":
     p.add_argument("--output", help="Augmented CSV output path (default: *_with_buckets.csv)")
     p.add_argument("--emotion-cm", help="Emotion confusion matrix CSV path (default: *_emotion_cm.csv)")
     p.add_argument("--domain-cm", help="Domain confusion matrix CSV path (default: *_domain_cm.csv)")
+    p.add_argument("--minimal-output", action="store_true",
+                   help="Write only the derived bucket/label columns to the augmented CSV")
     args = p.parse_args()
     sys.exit(main(args))